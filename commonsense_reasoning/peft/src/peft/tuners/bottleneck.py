@@ -1,6 +1,5 @@
 import importlib
 import math
-import re
 import warnings
 from dataclasses import asdict, dataclass, field
 from enum import Enum
@@ -10,7 +9,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from ..utils import PeftConfig, PeftType, transpose
+from ..utils import PeftConfig, PeftType, get_target_module_matcher, transpose
 from transformers.activations import ACT2FN
 
 
@@ -131,12 +130,9 @@ class BottleneckModel(torch.nn.Module):
             "init_weights": self.peft_config.init_weights,
         }
         key_list = [key for key, _ in self.model.named_modules()]
+        target_module_matcher = get_target_module_matcher(self.peft_config.target_modules)
         for key in key_list:
-            if isinstance(self.peft_config.target_modules, str):
-                target_module_found = re.fullmatch(self.peft_config.target_modules, key)
-            else:
-                target_module_found = any(key.endswith(target_key) for target_key in self.peft_config.target_modules)
-            if target_module_found:
+            if target_module_matcher(key):
                 if not is_target_modules_in_base_model:
                     is_target_modules_in_base_model = True
                 parent, target, target_name = self._get_submodules(key)
@@ -12,9 +12,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
 import importlib
 import math
-import re
+import threading
 import warnings
 from dataclasses import asdict, dataclass, field
 from enum import Enum
@@ -31,8 +32,16 @@ from transformers.pytorch_utils import Conv1D
 # from utils import PeftConfig, PeftType, transpose
 ####################  debug  ####################
 
-from ..utils import PeftConfig, PeftType, transpose
-from einops import rearrange
+from ..utils import PeftConfig, PeftType, get_target_module_matcher
+from .lora_kernels import (
+    ROUTER_GEMM_SOFTMAX_MAX_N,
+    fused_lora_forward,
+    fused_lora_supported,
+    is_numba_available,
+    is_triton_available,
+    lora_cpu_forward,
+    router_gemm_softmax,
+)
 
 
 def is_bnb_available():
@@ -42,6 +51,10 @@ def is_bnb_available():
 if is_bnb_available():
     import bitsandbytes as bnb
 
+# resolved once at import, the kernel dispatch checks them on every forward
+_triton_available = is_triton_available()
+_numba_available = is_numba_available()
+
 
 @dataclass
 class LoraConfig(PeftConfig):
@@ -60,6 +73,25 @@ class LoraConfig(PeftConfig):
         bias (`str`): Bias type for Lora. Can be 'none', 'all' or 'lora_only'
         modules_to_save (`List[str]`):List of modules apart from LoRA layers to be set as trainable
             and saved in the final checkpoint.
+        lora_router (`bool`): Whether to scale the LoRA rank components with a token-wise router.
+        lora_router_mixer (`bool`): Whether the router produces a full `r x r` mixer instead of a diagonal.
+        router_activation (`str`):
+            The normalization applied to the router logits. Can be 'softmax', 'sigmoid' or 'identity'. Checkpoints
+            trained with the softmax router should keep using 'softmax'.
+        lora_dtype (`str`): The dtype of the LoRA matrices, e.g. 'bfloat16'. Defaults to the dtype of the layer.
+        lora_compile (`bool`): Whether to compile the LoRA branch of every layer with `torch.compile`.
+        lora_router_kernel (`bool`):
+            Whether to compute the `lora_AR` projection and the softmax of the router with a Triton kernel on CUDA,
+            in training as well as in inference.
+        lora_fused_kernel (`bool`):
+            Whether to compute CUDA inference of the replaced layers with the fused Triton kernel, which also replaces
+            cuBLAS for the frozen projection. It autotunes once per power of 2 of the number of tokens and weight
+            shape, so it is opt-in.
+        lora_cpu_kernel (`bool`):
+            Whether to compute the LoRA branch with the Numba kernel for CPU inference. It only pays off for short
+            inputs and is slower than the eager path for long sequences and the mixer, so it is opt-in.
+        quantize_base (`bool`): Whether to quantize the frozen weights of the replaced layers to 4 bits (QLoRA).
+        bnb_4bit_quant_type (`str`): The 4-bit data type used with `quantize_base`. Can be 'nf4' or 'fp4'.
     """
 
     r: int = field(default=8, metadata={"help": "Lora attention dimension"})
@@ -93,9 +125,62 @@ class LoraConfig(PeftConfig):
     # expert_B: int = field(default=1, metadata={"help": "expert for lora B"})
     lora_router: bool=field(default=False, metadata={"help": "whether to use router"})
     lora_router_mixer: bool=field(default=False, metadata={"help": "whether to use router mixer"})
+    router_activation: str = field(
+        default="softmax",
+        metadata={"help": "Normalization of the router logits. Can be 'softmax', 'sigmoid' or 'identity'"},
+    )
+    lora_dtype: Optional[str] = field(
+        default=None,
+        metadata={"help": "dtype of the Lora matrices, e.g. 'bfloat16'. Defaults to the dtype of the layer."},
+    )
+    lora_compile: bool = field(
+        default=False, metadata={"help": "Whether to compile the LoRA branch of every layer with `torch.compile`"}
+    )
+    lora_router_kernel: bool = field(
+        default=False, metadata={"help": "Whether to fuse the router softmax into the lora_AR GEMM on CUDA"}
+    )
+    lora_fused_kernel: bool = field(
+        default=False, metadata={"help": "Whether to use the fused Triton kernel for CUDA inference of Lora layers"}
+    )
+    lora_cpu_kernel: bool = field(
+        default=False, metadata={"help": "Whether to use the Numba kernel for the LoRA branch in CPU inference"}
+    )
+    quantize_base: bool = field(
+        default=False, metadata={"help": "Whether to quantize the frozen weights of the replaced layers to 4 bits"}
+    )
+    bnb_4bit_quant_type: str = field(
+        default="nf4", metadata={"help": "4-bit data type used with `quantize_base`. Can be 'nf4' or 'fp4'"}
+    )
 
     def __post_init__(self):
         self.peft_type = PeftType.LORA
+        self._cache_dict()
+
+    def __setattr__(self, name, value):
+        # the config is still updated after construction (`get_peft_model`, `save_pretrained`, `fan_in_fan_out`
+        # fixes), so every assignment drops the cached dict and the next `_as_dict` call rebuilds it
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, "_cached_dict", None)
+
+    def _cache_dict(self):
+        cached_dict = {k: v.value if isinstance(v, Enum) else v for k, v in asdict(self).items()}
+        object.__setattr__(self, "_cached_dict", cached_dict)
+        object.__setattr__(
+            self, "_cached_container_keys", tuple(k for k, v in cached_dict.items() if isinstance(v, (list, dict)))
+        )
+
+    def _as_dict(self):
+        """
+        Returns the config as a new dict, like `asdict`, without walking the dataclass on every call.
+        """
+        if getattr(self, "_cached_dict", None) is None:
+            self._cache_dict()
+        config = dict(self._cached_dict)
+        # lists and dicts such as `target_modules` can be updated in place, which `__setattr__` does not see, so they
+        # are copied from the fields on every call; this also keeps callers from sharing them with the cache
+        for k in self._cached_container_keys:
+            config[k] = copy.deepcopy(getattr(self, k))
+        return config
 
 
 class LoraModel(torch.nn.Module):
@@ -127,7 +212,7 @@ class LoraModel(torch.nn.Module):
         self.peft_config = config
         self.model = model
         self._find_and_replace()
-        mark_only_lora_as_trainable(self.model, self.peft_config.bias)
+        mark_only_lora_as_trainable(self.model, self.peft_config.bias, self._lora_layers)
         self.forward = self.model.forward
 
     def _find_and_replace(self):
@@ -137,6 +222,11 @@ class LoraModel(torch.nn.Module):
                 "To use Lora with 8-bit quantization, please install the `bitsandbytes` package. "
                 "You can install it with `pip install bitsandbytes`."
             )
+        if self.peft_config.quantize_base and not is_bnb_available():
+            raise ImportError(
+                "To use Lora with 4-bit quantization, please install the `bitsandbytes` package. "
+                "You can install it with `pip install bitsandbytes`."
+            )
         is_target_modules_in_base_model = False
         is_hf_device_map_available = hasattr(self.model, "hf_device_map")
         kwargs = {
@@ -150,14 +240,21 @@ class LoraModel(torch.nn.Module):
             # "expert_B": self.peft_config.expert_B,
             "lora_router": self.peft_config.lora_router,
             "lora_router_mixer": self.peft_config.lora_router_mixer,
+            "router_activation": self.peft_config.router_activation,
+            "lora_dtype": self.peft_config.lora_dtype,
+            "lora_compile": self.peft_config.lora_compile,
+            "lora_router_kernel": self.peft_config.lora_router_kernel,
+            "lora_fused_kernel": self.peft_config.lora_fused_kernel,
+            "lora_cpu_kernel": self.peft_config.lora_cpu_kernel,
         }
-        key_list = [key for key, _ in self.model.named_modules()]
+        # one traversal serves every lookup below instead of walking the tree from the root for each key
+        self._module_map = dict(self.model.named_modules())
+        key_list = list(self._module_map)
+        target_module_matcher = get_target_module_matcher(self.peft_config.target_modules)
+        # the inserted layers, so that later passes over them need no module traversal
+        self._lora_layers = []
         for key in key_list:
-            if isinstance(self.peft_config.target_modules, str):
-                target_module_found = re.fullmatch(self.peft_config.target_modules, key)
-            else:
-                target_module_found = any(key.endswith(target_key) for target_key in self.peft_config.target_modules)
-            if target_module_found:
+            if target_module_matcher(key):
                 if not is_target_modules_in_base_model:
                     is_target_modules_in_base_model = True
                 parent, target, target_name = self._get_submodules(key)
@@ -176,6 +273,19 @@ class LoraModel(torch.nn.Module):
                     else:
                         kwargs.update({"enable_lora": self.peft_config.enable_lora})
                         new_module = MergedLinear8bitLt(target.in_features, target.out_features, bias=bias, **kwargs)
+                elif (
+                    self.peft_config.quantize_base
+                    and isinstance(target, torch.nn.Linear)
+                    and self.peft_config.enable_lora is None
+                ):
+                    kwargs.update(
+                        {
+                            "compute_dtype": torch.bfloat16,
+                            "compress_statistics": True,
+                            "quant_type": self.peft_config.bnb_4bit_quant_type,
+                        }
+                    )
+                    new_module = Linear4bit(target.in_features, target.out_features, bias=bias, **kwargs)
                 elif isinstance(target, torch.nn.Linear) and self.peft_config.enable_lora is None:
                     new_module = Linear(target.in_features, target.out_features, bias=bias, **kwargs)
                 elif self.peft_config.enable_lora is not None:
@@ -194,6 +304,9 @@ class LoraModel(torch.nn.Module):
                             kwargs["fan_in_fan_out"] = self.peft_config.fan_in_fan_out = False
                     new_module = MergedLinear(in_features, out_features, bias=bias, **kwargs)
                 self._replace_module(parent, target_name, new_module, target)
+                self._lora_layers.append(new_module)
+        # the map still references the replaced modules
+        del self._module_map
         if not is_target_modules_in_base_model:
             raise ValueError(
                 f"Target modules {self.peft_config.target_modules} not found in the base model. "
@@ -201,14 +314,29 @@ class LoraModel(torch.nn.Module):
             )
 
     def _get_submodules(self, key):
-        parent = self.model.get_submodule(".".join(key.split(".")[:-1]))
-        target_name = key.split(".")[-1]
-        target = self.model.get_submodule(key)
-        return parent, target, target_name
+        parent_key, _, target_name = key.rpartition(".")
+        return self._module_map[parent_key], self._module_map[key], target_name
 
     def _replace_module(self, parent_module, child_name, new_module, old_module):
         setattr(parent_module, child_name, new_module)
-        new_module.weight = old_module.weight
+        if is_bnb_available() and isinstance(new_module, Linear4bit):
+            weight = old_module.weight.data
+            if self.peft_config.fan_in_fan_out:
+                # same layout fix as for `Linear` below, it has to happen before the weight is quantized
+                weight = weight.T.contiguous()
+            # the weight is quantized once it is moved to the GPU
+            new_module.weight = bnb.nn.Params4bit(
+                weight.to("cpu"),
+                requires_grad=False,
+                compress_statistics=new_module.weight.compress_statistics,
+                quant_type=new_module.weight.quant_type,
+            )
+            new_module.to(old_module.weight.device)
+        else:
+            new_module.weight = old_module.weight
+            if isinstance(new_module, Linear) and self.peft_config.fan_in_fan_out:
+                # `Linear` always stores (out_features, in_features), store the (fan_in, fan_out) weight that way
+                new_module.weight.data = new_module.weight.data.T.contiguous()
         if old_module.bias is not None:
             new_module.bias = old_module.bias
         if getattr(old_module, "state", None) is not None:
@@ -232,15 +360,14 @@ class LoraModel(torch.nn.Module):
         return None
 
     def get_peft_config_as_dict(self, inference: bool = False):
-        config = {k: v.value if isinstance(v, Enum) else v for k, v in asdict(self.peft_config).items()}
+        config = self.peft_config._as_dict()
         if inference:
             config["inference_mode"] = True
         return config
 
     def _set_adapter_layers(self, enabled=True):
-        for module in self.model.modules():
-            if isinstance(module, LoraLayer):
-                module.disable_adapters = False if enabled else True
+        for module in self._lora_layers:
+            module.disable_adapters = False if enabled else True
 
     def enable_adapter_layers(self):
         self._set_adapter_layers(enabled=True)
@@ -260,22 +387,46 @@ class LoraModel(torch.nn.Module):
 
 
 # had to adapt it for `lora_only` to work
-def mark_only_lora_as_trainable(model: nn.Module, bias: str = "none") -> None:
-    for n, p in model.named_parameters():
-        if "lora_" not in n:
-            p.requires_grad = False
-    if bias == "none":
-        return
-    elif bias == "all":
-        for n, p in model.named_parameters():
-            if "bias" in n:
-                p.requires_grad = True
-    elif bias == "lora_only":
-        for m in model.modules():
-            if isinstance(m, LoraLayer) and hasattr(m, "bias") and m.bias is not None:
-                m.bias.requires_grad = True
-    else:
+def mark_only_lora_as_trainable(
+    model: nn.Module, bias: str = "none", lora_layers: Optional[List["LoraLayer"]] = None
+) -> None:
+    if bias not in ("none", "all", "lora_only"):
         raise NotImplementedError
+    lora_bias_ids = set()
+    if bias == "lora_only":
+        # `lora_layers` lets callers that already know the inserted layers skip the module walk
+        if lora_layers is None:
+            lora_layers = [m for m in model.modules() if isinstance(m, LoraLayer)]
+        lora_bias_ids = {id(m.bias) for m in lora_layers if getattr(m, "bias", None) is not None}
+    with torch.no_grad():
+        # a single pass decides every parameter, including the biases; flags that already have the right value are
+        # left alone, so repeated calls on an unchanged model write nothing
+        for n, p in model.named_parameters():
+            trainable = "lora_" in n or (bias == "all" and "bias" in n) or id(p) in lora_bias_ids
+            if p.requires_grad != trainable:
+                p.requires_grad_(trainable)
+
+
+def _softmax_router(router_weight):
+    return torch.softmax(router_weight, dim=-1)
+
+
+def _sigmoid_router(router_weight):
+    # in place when autograd allows it; the views returned by `split` cannot be modified in place under autograd
+    if router_weight.requires_grad:
+        return torch.sigmoid(router_weight)
+    return torch.sigmoid_(router_weight)
+
+
+def _identity_router(router_weight):
+    return router_weight
+
+
+ROUTER_ACTIVATIONS = {
+    "softmax": _softmax_router,
+    "sigmoid": _sigmoid_router,
+    "identity": _identity_router,
+}
 
 
 class LoraLayer:
@@ -298,6 +449,233 @@ class LoraLayer:
         self.merge_weights = merge_weights
         self.disable_adapters = False
 
+    def _init_lora(
+        self,
+        in_features: int,
+        out_features: int,
+        lora_router: bool,
+        lora_router_mixer: bool,
+        router_activation: str,
+        lora_dtype: Optional[str],
+        lora_compile: bool = False,
+        lora_router_kernel: bool = False,
+    ):
+        if router_activation not in ROUTER_ACTIVATIONS:
+            raise ValueError(
+                f"Unknown router_activation {router_activation}, should be one of {list(ROUTER_ACTIVATIONS)}"
+            )
+        self.lora_router = lora_router
+        self.lora_router_mixer = lora_router_mixer
+        self.router_activation = router_activation
+        self._router_activation = ROUTER_ACTIVATIONS[router_activation]
+        self.lora_router_kernel = lora_router_kernel
+        if lora_router_kernel and not _triton_available:
+            warnings.warn("lora_router_kernel is set to True but triton is not installed, ignoring it.")
+        # Actual trainable parameters
+        if self.r > 0:
+            # self.lora_A = nn.ModuleList([nn.Linear(in_features, r, bias=False) for _ in range(expert_A)])
+            # self.lora_B = nn.ModuleList([nn.Linear(r, out_features, bias=False) for _ in range(expert_B)])
+
+            # we set hyper-parameter here: lora_head = 4
+            self.lora_head = 4
+            self.in_per_head = in_features // self.lora_head
+            self.out_per_head = out_features // self.lora_head
+            # lora_A and the router lora_R read the same input, so they share one projection
+            if not self.lora_router:
+                self.r_router = 0
+                self._route = self._route_identity
+            elif self.lora_router_mixer:
+                self.r_router = self.r**2
+                self._route = self._route_mixer
+            else:
+                self.r_router = self.r
+                self._route = self._route_diagonal
+            self.lora_AR = nn.Linear(self.in_per_head, self.r + self.r_router, bias=False)
+            self.lora_B = nn.Linear(self.r, self.out_per_head, bias=False)
+            self.scaling = self.lora_alpha / self.r
+            # with `merge_weights`, eval mode keeps the scaling folded into lora_B
+            self._scaling_folded = False
+            self.scaling_runtime = self.scaling
+            # Freezing the pre-trained weight matrix
+            self.weight.requires_grad = False
+            # self.scale_a = 1./math.sqrt(expert_A)
+            # self.scale_b = 1./math.sqrt(expert_B)
+            self._register_load_state_dict_pre_hook(self._load_lora_AR_pre_hook)
+            self._register_load_state_dict_pre_hook(self._load_lora_B_pre_hook)
+            self._register_state_dict_hook(self._lora_B_state_dict_hook)
+            self.reset_lora_parameters()
+            if lora_dtype is not None:
+                # initialized in full precision above, then stored in the lower precision
+                self.lora_AR.to(dtype=getattr(torch, lora_dtype))
+                self.lora_B.to(dtype=getattr(torch, lora_dtype))
+            # the branch is a chain of small kernels, which inductor fuses and which makes Python dispatch dominate
+            # at small ranks. Every layer compiles the same `_lora_forward`, so they all share one recompile limit;
+            # `dynamic=None` turns a changing number of tokens into a dynamic dim after the first recompile instead of
+            # compiling a graph per sequence length until the limit is hit and every layer silently runs eager
+            self._lora_body = self._lora_forward
+            self._lora_compiled = False
+            # persistent buffers of `_add_lora_inplace`, allocated on first use
+            self._scratch = None
+            if lora_compile:
+                if hasattr(torch, "compile"):
+                    self._lora_compiled = True
+                    self._lora_body = torch.compile(
+                        self._lora_forward, dynamic=None, fullgraph=False, mode="reduce-overhead"
+                    )
+                else:
+                    warnings.warn("lora_compile is set to True but torch.compile requires torch>=2.0, ignoring it.")
+
+    def reset_lora_parameters(self):
+        if hasattr(self, "lora_AR"):
+            # initialize A and R the same way as the default for nn.Linear and B to zero
+            # both share the fan-in, so initializing the concatenated weight is the same as initializing each
+            nn.init.kaiming_uniform_(self.lora_AR.weight, a=math.sqrt(5))
+            # nn.init.kaiming_uniform_(self.lora_B.weight, a=math.sqrt(5))
+            nn.init.zeros_(self.lora_B.weight)
+
+    def _load_lora_AR_pre_hook(self, state_dict, prefix, *args):
+        # checkpoints saved before the fusion store `lora_A` and `lora_R` separately
+        lora_A_key, lora_R_key = prefix + "lora_A.weight", prefix + "lora_R.weight"
+        if lora_A_key in state_dict:
+            weights = [state_dict.pop(lora_A_key)]
+            if lora_R_key in state_dict:
+                weights.append(state_dict.pop(lora_R_key))
+            state_dict[prefix + "lora_AR.weight"] = torch.cat(weights, dim=0)
+
+    def _load_lora_B_pre_hook(self, state_dict, prefix, *args):
+        # checkpoints always hold the unscaled lora_B
+        lora_B_key = prefix + "lora_B.weight"
+        if self._scaling_folded and lora_B_key in state_dict:
+            state_dict[lora_B_key] = state_dict[lora_B_key] * self.scaling
+
+    @staticmethod
+    def _lora_B_state_dict_hook(module, state_dict, prefix, local_metadata):
+        lora_B_key = prefix + "lora_B.weight"
+        if module._scaling_folded and lora_B_key in state_dict:
+            state_dict[lora_B_key] = state_dict[lora_B_key] / module.scaling
+
+    def _fold_scaling(self, fold: bool):
+        if fold == self._scaling_folded:
+            return
+        with torch.no_grad():
+            if fold:
+                self.lora_B.weight.mul_(self.scaling)
+            else:
+                self.lora_B.weight.div_(self.scaling)
+        self._scaling_folded = fold
+        self.scaling_runtime = 1.0 if fold else self.scaling
+
+    def _route_identity(self, lora_AR_result, router_activated=False):
+        # without a router lora_AR only holds lora_A
+        return lora_AR_result
+
+    def _route_diagonal(self, lora_AR_result, router_activated=False):
+        left_result, router_weight = lora_AR_result.split([self.r, self.r_router], dim=-1)
+        if not router_activated:
+            router_weight = self._router_activation(router_weight)
+        # a diagonal router only rescales each rank component
+        return left_result * router_weight
+
+    def _route_mixer(self, lora_AR_result, router_activated=False):
+        left_result, router_weight = lora_AR_result.split([self.r, self.r_router], dim=-1)
+        if not router_activated:
+            router_weight = self._router_activation(router_weight)
+        # both views only merge leading dims or split the last one, so they are free and the contraction is one
+        # batched GEMM
+        router_weight = router_weight.view(-1, self.r, self.r)
+        return torch.bmm(left_result.reshape(-1, 1, self.r), router_weight).view_as(left_result)
+
+    def _use_router_kernel(self, x: torch.Tensor):
+        # opt-in; the softmax epilogue needs the whole lora_AR row in registers, which rules out large mixers
+        return (
+            self.lora_router_kernel
+            and x.is_cuda
+            and _triton_available
+            and self.lora_router
+            and self.router_activation == "softmax"
+            and self.r + self.r_router <= ROUTER_GEMM_SOFTMAX_MAX_N
+        )
+
+    def forward_B(self, x):
+        # res = [l(x) for l in self.lora_B]
+        # return self.scale_b*torch.sum(torch.stack(res, dim=-1).to(device=x.device), dim=-1, keepdim=False)
+        return self.lora_B(x)
+
+    def _lora_forward(self, x: torch.Tensor):
+        dropout_x = self.lora_dropout(x)
+        if dropout_x.dtype != self.lora_AR.weight.dtype:
+            dropout_x = dropout_x.to(self.lora_AR.weight.dtype)
+        # ... (h d) -> ... h d, the heads share lora_AR and lora_B, so they stay a separate dim of a free view and
+        # every projection runs as a single GEMM over all heads without permuting to (b h) s d and back
+        dropout_x = dropout_x.reshape(x.shape[:-1] + (self.lora_head, self.in_per_head))
+
+        # `_route` is bound in `_init_lora` from the router config
+        if self._use_router_kernel(dropout_x):
+            lora_AR_result = router_gemm_softmax(dropout_x, self.lora_AR.weight, self.r)
+            moe_result = self._route(lora_AR_result, router_activated=True)
+        else:
+            moe_result = self._route(self.lora_AR(dropout_x))
+
+        lora_result = self.forward_B(moe_result)
+        if self.scaling_runtime != 1.0:
+            lora_result = lora_result * self.scaling_runtime
+
+        # ... h d -> ... (h d)
+        return lora_result.reshape(x.shape[:-1] + (-1,))
+
+    def _get_scratch(self, rows, device, dtype):
+        # keyed on everything that decides the buffers: a new sequence length or device reallocates them, buffers made
+        # under `torch.inference_mode` cannot be written outside of it, and the thread id keeps concurrent threads from
+        # writing into the same buffers. There is a single slot, so threads that alternate reallocate each time.
+        key = (rows, device, dtype, torch.is_inference_mode_enabled(), threading.get_ident())
+        scratch = self._scratch
+        if scratch is None or scratch[0] != key:
+            scratch = self._scratch = (
+                key,
+                torch.empty((rows, self.r + self.r_router), device=device, dtype=dtype),
+                torch.empty((rows, self.r_router), device=device, dtype=dtype),
+                torch.empty((rows, self.r), device=device, dtype=dtype),
+            )
+        return scratch[1:]
+
+    def _add_lora_inplace(self, x: torch.Tensor, result: torch.Tensor):
+        # inference only variant of `_lora_forward`: the rank-sized intermediates are written into the scratch buffers
+        # with `out=` and lora_B adds the update to `result` in place. Nothing of the output size is kept on the layer,
+        # callers such as a KV cache may keep views of `result`.
+        dropout_x = self.lora_dropout(x)
+        if dropout_x.dtype != self.lora_AR.weight.dtype:
+            dropout_x = dropout_x.to(self.lora_AR.weight.dtype)
+        # ... (h d) -> (... h) d, the heads share the weights so they are just more rows
+        dropout_x = dropout_x.reshape(-1, self.in_per_head)
+        lora_AR_result, router_weight, moe_result = self._get_scratch(
+            dropout_x.shape[0], dropout_x.device, dropout_x.dtype
+        )
+
+        torch.mm(dropout_x, self.lora_AR.weight.t(), out=lora_AR_result)
+        if self.lora_router:
+            left_result, router_logits = lora_AR_result.split([self.r, self.r_router], dim=-1)
+            if self.router_activation == "softmax":
+                torch.softmax(router_logits, dim=-1, out=router_weight)
+            elif self.router_activation == "sigmoid":
+                torch.sigmoid(router_logits, out=router_weight)
+            else:
+                router_weight.copy_(router_logits)
+            if self.lora_router_mixer:
+                torch.bmm(
+                    left_result.unsqueeze(1), router_weight.view(-1, self.r, self.r), out=moe_result.unsqueeze(1)
+                )
+            else:
+                torch.mul(left_result, router_weight, out=moe_result)
+        else:
+            moe_result = lora_AR_result
+
+        if result.dtype == moe_result.dtype and result.is_contiguous():
+            # ... (h d) -> (... h) d is a free view of `result`, so lora_B accumulates into it directly
+            result.view(-1, self.out_per_head).addmm_(moe_result, self.lora_B.weight.t(), alpha=self.scaling_runtime)
+            return result
+        lora_result = torch.mm(moe_result, self.lora_B.weight.t())
+        return result.add_(lora_result.view(result.shape), alpha=self.scaling_runtime)
+
 
 class Linear(nn.Linear, LoraLayer):
     # Lora implemented in a dense layer
@@ -314,118 +692,171 @@ class Linear(nn.Linear, LoraLayer):
         # expert_B: int = 1,
         lora_router: bool=False,
         lora_router_mixer: bool=False,
+        router_activation: str = "softmax",
+        lora_dtype: Optional[str] = None,
+        lora_compile: bool = False,
+        lora_router_kernel: bool = False,
+        lora_fused_kernel: bool = False,
+        lora_cpu_kernel: bool = False,
         **kwargs,
     ):  
         nn.Linear.__init__(self, in_features, out_features, **kwargs)
         LoraLayer.__init__(self, r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout, merge_weights=merge_weights)
 
-        self.fan_in_fan_out = fan_in_fan_out
-        self.lora_router = lora_router
-        self.lora_router_mixer = lora_router_mixer
-        # Actual trainable parameters
+        # the weight always keeps the (out_features, in_features) layout of nn.Linear, so forward never needs to
+        # transpose; a (fan_in, fan_out) weight is transposed once when it is loaded, see `LoraModel._replace_module`
+        self.fan_in_fan_out = False
+        self.lora_fused_kernel = lora_fused_kernel
+        if lora_fused_kernel and not _triton_available:
+            warnings.warn("lora_fused_kernel is set to True but triton is not installed, ignoring it.")
+        self.lora_cpu_kernel = lora_cpu_kernel
+        if lora_cpu_kernel and not _numba_available:
+            warnings.warn("lora_cpu_kernel is set to True but numba is not installed, ignoring it.")
+        self._init_lora(
+            in_features,
+            out_features,
+            lora_router,
+            lora_router_mixer,
+            router_activation,
+            lora_dtype,
+            lora_compile=lora_compile,
+            lora_router_kernel=lora_router_kernel,
+        )
         if r > 0:
-            # self.lora_A = nn.ModuleList([nn.Linear(in_features, r, bias=False) for _ in range(expert_A)])
-            # self.lora_B = nn.ModuleList([nn.Linear(r, out_features, bias=False) for _ in range(expert_B)])
-            
-            # we set hyper-parameter here: lora_head = 4
-            lora_head = 4
-            self.lora_A = nn.Linear(in_features//lora_head, r, bias=False)
-            if self.lora_router:
-                if self.lora_router_mixer:
-                    self.lora_R = nn.Linear(in_features//lora_head, r**2, bias=False)
-                else:
-                    self.lora_R = nn.Linear(in_features//lora_head, r, bias=False)
-            self.lora_B = nn.Linear(r, out_features//lora_head, bias=False)
-            self.scaling = self.lora_alpha / self.r
-            # Freezing the pre-trained weight matrix
-            self.weight.requires_grad = False
-            # self.scale_a = 1./math.sqrt(expert_A)
-            # self.scale_b = 1./math.sqrt(expert_B)
-        self.reset_parameters()
-        if fan_in_fan_out:
-            self.weight.data = self.weight.data.T
+            self._register_load_state_dict_pre_hook(self._unmerge_pre_hook)
+            # the fused kernel keeps the router tile in registers, larger mixers stay on the eager path
+            self._fused_kernel_supported = fused_lora_supported(
+                self.r, self.lora_head, self.lora_router and self.lora_router_mixer
+            )
 
     def reset_parameters(self):
         nn.Linear.reset_parameters(self)
-        if hasattr(self, "lora_A"):
-            # initialize A the same way as the default for nn.Linear and B to zero
-            # for idx in range(len(self.lora_A)):
-            nn.init.kaiming_uniform_(self.lora_A.weight, a=math.sqrt(5))
-            # for idx in range(len(self.lora_B)):
-            if self.lora_router:
-                nn.init.kaiming_uniform_(self.lora_R.weight, a=math.sqrt(5))
-            # nn.init.kaiming_uniform_(self.lora_B.weight, a=math.sqrt(5))
-            nn.init.zeros_(self.lora_B.weight)
-    
-    def forward_A(self, x):
-        # res = [l(x) for l in self.lora_A]
-        # return self.scale_a*torch.sum(torch.stack(res, dim=-1).to(device=x.device), dim=-1, keepdim=False)
-        return self.lora_A(x)
-    def forward_B(self, x):
-        # res = [l(x) for l in self.lora_B]
-        # return self.scale_b*torch.sum(torch.stack(res, dim=-1).to(device=x.device), dim=-1, keepdim=False)
-        return self.lora_B(x)
+        self.reset_lora_parameters()
+
+    def get_delta_weight(self):
+        # every head applies the same B @ A to its slice of the features, so the update is block diagonal
+        delta_weight = (self.lora_B.weight @ self.lora_AR.weight[: self.r]) * self.scaling_runtime
+        return torch.block_diag(*[delta_weight] * self.lora_head).to(self.weight.dtype)
+
+    def _merge(self):
+        if self.merged:
+            return
+        with torch.no_grad():
+            self.weight.add_(self.get_delta_weight())
+        self.merged = True
+
+    def _unmerge(self):
+        if not self.merged:
+            return
+        with torch.no_grad():
+            self.weight.sub_(self.get_delta_weight())
+        self.merged = False
+
+    def _unmerge_pre_hook(self, state_dict, prefix, *args):
+        # the merged update belongs to the LoRA weights that are about to be replaced
+        self._unmerge()
     
     def train(self, mode: bool = True):
         nn.Linear.train(self, mode)
-        # for idx in range(len(self.lora_A)):
-        self.lora_A.train(mode)
+        self.lora_AR.train(mode)
         # for idx in range(len(self.lora_B)):
-        if self.lora_router:
-            self.lora_R.train(mode)
         self.lora_B.train(mode)
-
-        self.merged = False
+        if mode:
+            # the scratch buffers only serve inference, so they are released while training
+            self._scratch = None
+        if self.merge_weights:
+            if self.lora_router:
+                # the router depends on the input, so only the scaling can be folded
+                self._fold_scaling(not mode)
+            elif mode:
+                self._unmerge()
+            else:
+                self._merge()
 
     def eval(self):
         nn.Linear.eval(self)
-        # for idx in range(len(self.lora_A)):
-        self.lora_A.eval()
+        self.lora_AR.eval()
         # for idx in range(len(self.lora_B)):
-        if self.lora_router:
-            self.lora_R.eval()
         self.lora_B.eval()
 
+    def _use_fused_kernel(self, x: torch.Tensor):
+        # opt-in; the Triton kernel records no autograd graph and skips dropout, so it only serves inference
+        return (
+            self.lora_fused_kernel
+            and x.is_cuda
+            and _triton_available
+            and self._fused_kernel_supported
+            and not self.training
+            and not torch.is_grad_enabled()
+        )
+
+    def _use_cpu_kernel(self, x: torch.Tensor):
+        # opt-in, and the same restrictions as the Triton kernel since the Numba kernel works outside of autograd
+        return (
+            self.lora_cpu_kernel
+            and x.device.type == "cpu"
+            and _numba_available
+            and not self.training
+            and not torch.is_grad_enabled()
+        )
+
+    def _use_scratch(self, x: torch.Tensor):
+        # `out=` writes cannot be recorded by autograd, and a compiled branch or model already plans its own buffers;
+        # tracing the cache lookup would also break the graph in every layer
+        return (
+            not self.training
+            and not torch.is_grad_enabled()
+            and not self._lora_compiled
+            and not (hasattr(torch, "compiler") and torch.compiler.is_compiling())
+        )
+
     def forward(self, x: torch.Tensor):
         previous_dtype = self.weight.dtype
 
         if self.disable_adapters:
-            raise NotImplementedError("Disabling adapters is not supported for LoraLayer yet")
-        
-        dropout_x = self.lora_dropout(x).to(self.lora_A.weight.dtype)
-        # we set hyper-parameter here: lora_head = 4
-        lora_head = 4
-        dropout_x_shape = dropout_x.shape 
-        if len(dropout_x_shape) == 3:
-            dropout_x = rearrange(dropout_x, 'b s (h d) -> (b h) s d', h=lora_head)
-        else:
-            dropout_x = rearrange(dropout_x, 'b (h d) -> (b h) d', h=lora_head)
-
-        left_result = self.forward_A(dropout_x)
-        router_weight = self.lora_R(dropout_x)
-        if self.lora_router:
-            router_weight = torch.softmax(router_weight, dim=-1)
-
-            if not self.lora_router_mixer:
-                router_weight = torch.diag_embed(router_weight)
-            else:
-                router_weight_shape = router_weight.shape[:-1] + (self.r, self.r)
-                router_weight = router_weight.reshape(router_weight_shape)
-
-        if len(router_weight.shape) == 3:
-            moe_result = torch.enisum('br, brk->bk', left_result, router_weight)
-        else:
-            moe_result = torch.einsum('bnr, bnrk->bnk', left_result, router_weight)
-
-        lora_result = self.forward_B(moe_result) * self.scaling
-        
-        if len(dropout_x_shape) == 3:
-            lora_result = rearrange(lora_result, '(b h) s d -> b s (h d)', h=lora_head)
+            self._unmerge()
+            return F.linear(x, self.weight, bias=self.bias)
+
+        if self.merged:
+            return F.linear(x, self.weight, bias=self.bias)
+
+        if self._use_fused_kernel(x):
+            result = fused_lora_forward(
+                x,
+                self.weight,
+                self.lora_AR.weight[: self.r],
+                self.lora_B.weight,
+                self.lora_AR.weight[self.r :] if self.lora_router else None,
+                self.scaling_runtime,
+                self.lora_head,
+                bias=self.bias,
+                router_mixer=self.lora_router_mixer,
+                router_activation=self.router_activation,
+            )
+            return result.to(previous_dtype)
+
+        if self._use_cpu_kernel(x):
+            lora_result = lora_cpu_forward(
+                x,
+                self.lora_AR.weight[: self.r],
+                self.lora_B.weight,
+                self.lora_AR.weight[self.r :] if self.lora_router else None,
+                self.scaling_runtime,
+                self.lora_head,
+                router_mixer=self.lora_router_mixer,
+                router_activation=self.router_activation,
+            )
+        elif self._use_scratch(x):
+            result = self._add_lora_inplace(x, F.linear(x, self.weight, bias=self.bias))
+            if result.dtype != previous_dtype:
+                result = result.to(previous_dtype)
+            return result
         else:
-            lora_result = rearrange(lora_result, '(b h) d -> b (h d)', h=lora_head)
-            
-        org_result = F.linear(x, transpose(self.weight, self.fan_in_fan_out), bias=self.bias)
-        result = lora_result + org_result
+            lora_result = self._lora_body(x)
+        org_result = F.linear(x, self.weight, bias=self.bias)
+        if lora_result.dtype != org_result.dtype:
+            lora_result = lora_result.to(org_result.dtype)
+        result = org_result + lora_result
 
         if result.dtype != previous_dtype:
             result = result.to(previous_dtype)
@@ -477,7 +908,66 @@ if is_bnb_available():
             **kwargs,
         ):
             raise NotImplementedError
-        
+
+    class Linear4bit(bnb.nn.Linear4bit, LoraLayer):
+        # Lora implemented in a dense layer whose frozen weight is quantized to 4 bits
+        def __init__(
+            self,
+            in_features,
+            out_features,
+            r: int = 0,
+            lora_alpha: int = 1,
+            lora_dropout: float = 0.0,
+            lora_router: bool = False,
+            lora_router_mixer: bool = False,
+            router_activation: str = "softmax",
+            lora_dtype: Optional[str] = None,
+            lora_compile: bool = False,
+            lora_router_kernel: bool = False,
+            **kwargs,
+        ):
+            bnb.nn.Linear4bit.__init__(
+                self,
+                in_features,
+                out_features,
+                bias=kwargs.get("bias", True),
+                compute_dtype=kwargs.get("compute_dtype", torch.bfloat16),
+                compress_statistics=kwargs.get("compress_statistics", True),
+                quant_type=kwargs.get("quant_type", "nf4"),
+            )
+            LoraLayer.__init__(
+                self,
+                r=r,
+                lora_alpha=lora_alpha,
+                lora_dropout=lora_dropout,
+                merge_weights=kwargs.get("merge_weights", False),
+            )
+            self._init_lora(
+                in_features,
+                out_features,
+                lora_router,
+                lora_router_mixer,
+                router_activation,
+                lora_dtype,
+                lora_compile=lora_compile,
+                lora_router_kernel=lora_router_kernel,
+            )
+
+        def train(self, mode: bool = True):
+            bnb.nn.Linear4bit.train(self, mode)
+            if self.merge_weights:
+                self._fold_scaling(not mode)
+
+        def forward(self, x: torch.Tensor):
+            # the 4-bit weight is dequantized to `compute_dtype` on the fly; gradients only reach the LoRA matrices
+            result = bnb.nn.Linear4bit.forward(self, x)
+            if self.disable_adapters:
+                return result
+
+            lora_result = self._lora_body(x)
+            if lora_result.dtype != result.dtype:
+                lora_result = lora_result.to(result.dtype)
+            return result + lora_result
 
 
 if __name__ == '__main__':
@@ -0,0 +1,597 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import importlib
+
+import numpy as np
+import torch
+
+
+def is_triton_available():
+    return importlib.util.find_spec("triton") is not None
+
+
+def is_numba_available():
+    return importlib.util.find_spec("numba") is not None
+
+
+# the whole `r + r_router` row of the router GEMM has to stay in registers for the softmax epilogue
+ROUTER_GEMM_SOFTMAX_MAX_N = 128
+
+# widest tiles `fused_lora_forward` keeps in registers: the router tile of stage 1 (`r**2` columns with the mixer) and
+# the `lora_head * r` routed activations of stage 2
+FUSED_LORA_MAX_PAD = 256
+
+
+def _next_power_of_2(n):
+    return 1 << (n - 1).bit_length()
+
+
+def _dot_precision(dtype):
+    # `tl.dot` rounds float32 inputs to TF32 by default, follow the setting torch uses for its own float32 matmuls
+    return "tf32" if dtype == torch.float32 and torch.backends.cuda.matmul.allow_tf32 else "ieee"
+
+
+def fused_lora_supported(r, lora_head, router_mixer=False):
+    """
+    Returns whether [`fused_lora_forward`] can handle a layer of rank `r`, larger ranks fall back to the eager path.
+    """
+    rank_pad = max(16, _next_power_of_2(r))
+    router_pad = rank_pad * rank_pad if router_mixer else rank_pad
+    return router_pad <= FUSED_LORA_MAX_PAD and max(16, _next_power_of_2(lora_head * r)) <= FUSED_LORA_MAX_PAD
+
+
+if is_triton_available():
+    import triton
+    import triton.language as tl
+
+    # stage 1 only produces `r` (or `r**2`) columns per head, so there is nothing to tile along N
+    _ROUTER_CONFIGS = [
+        triton.Config({"BLOCK_M": block_m, "BLOCK_K": block_k}, num_stages=num_stages, num_warps=num_warps)
+        for block_m in [32, 64]
+        for block_k in [32, 64]
+        for num_stages in [3, 4]
+        for num_warps in [4, 8]
+    ]
+
+    _LINEAR_CONFIGS = [
+        triton.Config(
+            {"BLOCK_M": block_m, "BLOCK_N": block_n, "BLOCK_K": block_k}, num_stages=num_stages, num_warps=num_warps
+        )
+        for block_m in [64, 128]
+        for block_n in [64, 128, 256]
+        for block_k in [32, 64]
+        for num_stages in [3, 4]
+        for num_warps in [4, 8]
+    ]
+
+    # the autotune keys use `M_BUCKET`, the next power of 2 of M, so that every new number of tokens does not
+    # benchmark all configs again
+    @triton.autotune(configs=_ROUTER_CONFIGS, key=["M_BUCKET", "K_HEAD", "RANK"])
+    @triton.jit
+    def _lora_router_kernel(
+        x_ptr,
+        a_ptr,
+        r_ptr,
+        moe_ptr,
+        M,
+        M_BUCKET,
+        K_HEAD,
+        RANK,
+        stride_xm,
+        stride_xk,
+        stride_am,
+        stride_ak,
+        stride_rm,
+        stride_rk,
+        stride_om,
+        stride_oq,
+        HAS_ROUTER: tl.constexpr,
+        ROUTER_MIXER: tl.constexpr,
+        ROUTER_ACTIVATION: tl.constexpr,
+        RANK_PAD: tl.constexpr,
+        ROUTER_PAD: tl.constexpr,
+        DOT_PRECISION: tl.constexpr,
+        BLOCK_M: tl.constexpr,
+        BLOCK_K: tl.constexpr,
+    ):
+        # one program per (row tile, head): moe[m, head * r:(head + 1) * r] = route(x_h @ A^T, x_h @ R^T)
+        pid_m = tl.program_id(0)
+        head = tl.program_id(1)
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_k = tl.arange(0, BLOCK_K)
+        offs_r = tl.arange(0, RANK_PAD)
+        offs_q = tl.arange(0, ROUTER_PAD)
+        m_mask = offs_m < M
+        r_mask = offs_r < RANK
+        if ROUTER_MIXER:
+            # column q of the router tile holds entry (q // RANK_PAD, q % RANK_PAD) of the r x r mixer
+            q_mask = (offs_q // RANK_PAD < RANK) & (offs_q % RANK_PAD < RANK)
+            q_row = (offs_q // RANK_PAD) * RANK + offs_q % RANK_PAD
+        else:
+            q_mask = offs_q < RANK
+            q_row = offs_q
+
+        x_ptrs = x_ptr + offs_m[:, None] * stride_xm + (head * K_HEAD + offs_k[None, :]) * stride_xk
+        a_ptrs = a_ptr + offs_r[None, :] * stride_am + offs_k[:, None] * stride_ak
+        r_ptrs = r_ptr + q_row[None, :] * stride_rm + offs_k[:, None] * stride_rk
+
+        left = tl.zeros((BLOCK_M, RANK_PAD), dtype=tl.float32)
+        logits = tl.zeros((BLOCK_M, ROUTER_PAD), dtype=tl.float32)
+        for k in range(0, K_HEAD, BLOCK_K):
+            k_mask = offs_k < K_HEAD - k
+            x = tl.load(x_ptrs, mask=m_mask[:, None] & k_mask[None, :], other=0.0)
+            a = tl.load(a_ptrs, mask=k_mask[:, None] & r_mask[None, :], other=0.0)
+            left += tl.dot(x, a.to(x.dtype), input_precision=DOT_PRECISION)
+            if HAS_ROUTER:
+                rw = tl.load(r_ptrs, mask=k_mask[:, None] & q_mask[None, :], other=0.0)
+                logits += tl.dot(x, rw.to(x.dtype), input_precision=DOT_PRECISION)
+                r_ptrs += BLOCK_K * stride_rk
+            x_ptrs += BLOCK_K * stride_xk
+            a_ptrs += BLOCK_K * stride_ak
+
+        if HAS_ROUTER:
+            # padded rank components of `left` are zero, so only the softmax needs the padding masked
+            if ROUTER_ACTIVATION == "softmax":
+                logits = tl.where(q_mask[None, :], logits, float("-inf"))
+                numerator = tl.exp(logits - tl.max(logits, axis=1)[:, None])
+                router_weight = numerator / tl.sum(numerator, axis=1)[:, None]
+            elif ROUTER_ACTIVATION == "sigmoid":
+                router_weight = tl.sigmoid(logits)
+            else:
+                router_weight = logits
+            if ROUTER_MIXER:
+                router_weight = tl.reshape(router_weight, (BLOCK_M, RANK_PAD, RANK_PAD))
+                left = tl.sum(left[:, :, None] * router_weight, axis=1)
+            else:
+                left = left * router_weight
+
+        moe_ptrs = moe_ptr + offs_m[:, None] * stride_om + (head * RANK + offs_r[None, :]) * stride_oq
+        tl.store(moe_ptrs, left, mask=m_mask[:, None] & r_mask[None, :])
+
+    @triton.autotune(configs=_LINEAR_CONFIGS, key=["M_BUCKET", "N", "K"])
+    @triton.jit
+    def _fused_lora_linear_kernel(
+        x_ptr,
+        w_ptr,
+        moe_ptr,
+        b_ptr,
+        bias_ptr,
+        out_ptr,
+        M,
+        M_BUCKET,
+        N,
+        K,
+        N_HEAD,
+        RANK,
+        HEAD_RANK,
+        scaling,
+        stride_xm,
+        stride_xk,
+        stride_wn,
+        stride_wk,
+        stride_om,
+        stride_oq,
+        stride_bn,
+        stride_br,
+        stride_ym,
+        stride_yn,
+        HAS_BIAS: tl.constexpr,
+        HEAD_RANK_PAD: tl.constexpr,
+        DOT_PRECISION: tl.constexpr,
+        LORA_DOT_PRECISION: tl.constexpr,
+        BLOCK_M: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+        BLOCK_K: tl.constexpr,
+    ):
+        # out = x @ W^T + scaling * moe @ blockdiag(B, ..., B)^T (+ bias)
+        pid_m = tl.program_id(0)
+        pid_n = tl.program_id(1)
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_n = pid_n * BLOCK_N + tl.arange(0, BLOCK_N)
+        offs_k = tl.arange(0, BLOCK_K)
+        m_mask = offs_m < M
+        n_mask = offs_n < N
+
+        x_ptrs = x_ptr + offs_m[:, None] * stride_xm + offs_k[None, :] * stride_xk
+        w_ptrs = w_ptr + offs_n[None, :] * stride_wn + offs_k[:, None] * stride_wk
+
+        acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+        for k in range(0, K, BLOCK_K):
+            k_mask = offs_k < K - k
+            x = tl.load(x_ptrs, mask=m_mask[:, None] & k_mask[None, :], other=0.0)
+            w = tl.load(w_ptrs, mask=k_mask[:, None] & n_mask[None, :], other=0.0)
+            acc += tl.dot(x, w.to(x.dtype), input_precision=DOT_PRECISION)
+            x_ptrs += BLOCK_K * stride_xk
+            w_ptrs += BLOCK_K * stride_wk
+
+        # the column block of head h only sees moe[:, h * r:(h + 1) * r], which is the block-diagonal mask below
+        offs_q = tl.arange(0, HEAD_RANK_PAD)
+        q_mask = offs_q < HEAD_RANK
+        head_mask = (offs_q // RANK)[:, None] == (offs_n // N_HEAD)[None, :]
+        moe = tl.load(
+            moe_ptr + offs_m[:, None] * stride_om + offs_q[None, :] * stride_oq,
+            mask=m_mask[:, None] & q_mask[None, :],
+            other=0.0,
+        )
+        b = tl.load(
+            b_ptr + (offs_n % N_HEAD)[None, :] * stride_bn + (offs_q % RANK)[:, None] * stride_br,
+            mask=q_mask[:, None] & n_mask[None, :] & head_mask,
+            other=0.0,
+        )
+        acc += scaling * tl.dot(moe, b.to(tl.float32), input_precision=LORA_DOT_PRECISION)
+
+        if HAS_BIAS:
+            bias = tl.load(bias_ptr + offs_n, mask=n_mask, other=0.0)
+            acc += bias.to(tl.float32)[None, :]
+
+        out_ptrs = out_ptr + offs_m[:, None] * stride_ym + offs_n[None, :] * stride_yn
+        tl.store(out_ptrs, acc.to(out_ptr.dtype.element_ty), mask=m_mask[:, None] & n_mask[None, :])
+
+    _ROUTER_GEMM_CONFIGS = [
+        triton.Config({"BLOCK_M": block_m, "BLOCK_K": block_k}, num_stages=num_stages, num_warps=4)
+        for block_m in [32, 64, 128]
+        for block_k in [32, 64]
+        for num_stages in [3, 4]
+    ]
+
+    # bucketed like the kernels above, with dynamic padding every batch has a new number of tokens
+    @triton.autotune(configs=_ROUTER_GEMM_CONFIGS, key=["M_BUCKET", "N", "K"])
+    @triton.jit
+    def _router_gemm_softmax_kernel(
+        x_ptr,
+        w_ptr,
+        out_ptr,
+        M,
+        M_BUCKET,
+        N,
+        K,
+        RANK,
+        stride_xm,
+        stride_xk,
+        stride_wn,
+        stride_wk,
+        stride_om,
+        stride_on,
+        BLOCK_N: tl.constexpr,
+        DOT_PRECISION: tl.constexpr,
+        BLOCK_M: tl.constexpr,
+        BLOCK_K: tl.constexpr,
+    ):
+        # out = x @ w^T with a softmax over columns RANK:N applied before the tile leaves the registers
+        pid_m = tl.program_id(0)
+
+        offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+        offs_n = tl.arange(0, BLOCK_N)
+        offs_k = tl.arange(0, BLOCK_K)
+        m_mask = offs_m < M
+        n_mask = offs_n < N
+
+        x_ptrs = x_ptr + offs_m[:, None] * stride_xm + offs_k[None, :] * stride_xk
+        w_ptrs = w_ptr + offs_n[None, :] * stride_wn + offs_k[:, None] * stride_wk
+
+        acc = tl.zeros((BLOCK_M, BLOCK_N), dtype=tl.float32)
+        for k in range(0, K, BLOCK_K):
+            k_mask = offs_k < K - k
+            x = tl.load(x_ptrs, mask=m_mask[:, None] & k_mask[None, :], other=0.0)
+            w = tl.load(w_ptrs, mask=k_mask[:, None] & n_mask[None, :], other=0.0)
+            acc += tl.dot(x, w.to(x.dtype), input_precision=DOT_PRECISION)
+            x_ptrs += BLOCK_K * stride_xk
+            w_ptrs += BLOCK_K * stride_wk
+
+        # lora_A columns and the padding are masked out of the softmax, the lora_A columns are stored as they are
+        router_mask = (offs_n >= RANK) & n_mask
+        logits = tl.where(router_mask[None, :], acc, float("-inf"))
+        numerator = tl.exp(logits - tl.max(logits, axis=1)[:, None])
+        router_weight = numerator / tl.sum(numerator, axis=1)[:, None]
+        acc = tl.where(router_mask[None, :], router_weight, acc)
+
+        out_ptrs = out_ptr + offs_m[:, None] * stride_om + offs_n[None, :] * stride_on
+        tl.store(out_ptrs, acc.to(out_ptr.dtype.element_ty), mask=m_mask[:, None] & n_mask[None, :])
+
+
+def fused_lora_forward(
+    x, weight, lora_A, lora_B, lora_R, scaling, lora_head, bias=None, router_mixer=False, router_activation="softmax"
+):
+    """
+    Computes the frozen projection and the routed LoRA branch of [`~peft.tuners.lora.Linear`] in two Triton launches.
+
+    The first launch reads `x` head by head and writes the routed rank-`r` activations (`lora_head * r` floats per
+    row) to a scratch buffer, the second one computes `x @ weight^T` and adds the LoRA update from that buffer while
+    the output tile is still in registers. No autograd graph is recorded, so this is only meant for inference. Ranks
+    rejected by [`fused_lora_supported`] raise a `ValueError`.
+
+    Args:
+        x (`torch.Tensor`): Input of shape `(..., in_features)`.
+        weight (`torch.Tensor`): Frozen weight of shape `(out_features, in_features)`, any strides.
+        lora_A (`torch.Tensor`): Weight of shape `(r, in_features // lora_head)`.
+        lora_B (`torch.Tensor`): Weight of shape `(out_features // lora_head, r)`.
+        lora_R (`torch.Tensor`, *optional*):
+            Router weight of shape `(r, in_features // lora_head)`, or `(r**2, in_features // lora_head)` for the
+            mixer. `None` disables routing.
+        scaling (`float`): Scaling applied to the LoRA branch.
+        lora_head (`int`): The number of heads the features are split into.
+        bias (`torch.Tensor`, *optional*): Bias of the frozen projection.
+        router_mixer (`bool`): Whether `lora_R` produces a full `r x r` mixer instead of a diagonal.
+        router_activation (`str`): The normalization of the router logits, 'softmax', 'sigmoid' or 'identity'.
+    """
+    out_features, in_features = weight.shape
+    r = lora_A.shape[0]
+    leading_shape = x.shape[:-1]
+    if not fused_lora_supported(r, lora_head, router_mixer):
+        raise ValueError(f"fused_lora_forward does not support r={r} with router_mixer={router_mixer}")
+    x = x.reshape(-1, in_features)
+    M = x.shape[0]
+    m_bucket = triton.next_power_of_2(M)
+
+    moe = torch.empty((M, lora_head * r), device=x.device, dtype=torch.float32)
+    rank_pad = max(16, triton.next_power_of_2(r))
+    router = lora_R if lora_R is not None else lora_A
+    _lora_router_kernel[lambda meta: (triton.cdiv(M, meta["BLOCK_M"]), lora_head)](
+        x,
+        lora_A,
+        router,
+        moe,
+        M,
+        m_bucket,
+        in_features // lora_head,
+        r,
+        x.stride(0),
+        x.stride(1),
+        lora_A.stride(0),
+        lora_A.stride(1),
+        router.stride(0),
+        router.stride(1),
+        moe.stride(0),
+        moe.stride(1),
+        HAS_ROUTER=lora_R is not None,
+        ROUTER_MIXER=router_mixer,
+        ROUTER_ACTIVATION=router_activation,
+        RANK_PAD=rank_pad,
+        ROUTER_PAD=rank_pad * rank_pad if router_mixer else rank_pad,
+        DOT_PRECISION=_dot_precision(x.dtype),
+    )
+
+    out = torch.empty((M, out_features), device=x.device, dtype=x.dtype)
+    _fused_lora_linear_kernel[
+        lambda meta: (triton.cdiv(M, meta["BLOCK_M"]), triton.cdiv(out_features, meta["BLOCK_N"]))
+    ](
+        x,
+        weight,
+        moe,
+        lora_B,
+        bias if bias is not None else x,
+        out,
+        M,
+        m_bucket,
+        out_features,
+        in_features,
+        out_features // lora_head,
+        r,
+        lora_head * r,
+        scaling,
+        x.stride(0),
+        x.stride(1),
+        weight.stride(0),
+        weight.stride(1),
+        moe.stride(0),
+        moe.stride(1),
+        lora_B.stride(0),
+        lora_B.stride(1),
+        out.stride(0),
+        out.stride(1),
+        HAS_BIAS=bias is not None,
+        HEAD_RANK_PAD=max(16, triton.next_power_of_2(lora_head * r)),
+        DOT_PRECISION=_dot_precision(x.dtype),
+        # the routed activations are kept in float32
+        LORA_DOT_PRECISION=_dot_precision(torch.float32),
+    )
+    return out.view(*leading_shape, out_features)
+
+
+class _RouterGemmSoftmax(torch.autograd.Function):
+    @staticmethod
+    @torch.amp.custom_fwd(device_type="cuda")
+    def forward(ctx, x, weight, r):
+        ctx.x_dtype, ctx.weight_dtype = x.dtype, weight.dtype
+        if torch.is_autocast_enabled("cuda"):
+            # autocast does not reach into the kernel, so apply the cast it would do for the eager `lora_AR` GEMM
+            dtype = torch.get_autocast_dtype("cuda")
+            x, weight = x.to(dtype), weight.to(dtype)
+        N, K = weight.shape
+        M = x.shape[0]
+        out = torch.empty((M, N), device=x.device, dtype=x.dtype)
+        _router_gemm_softmax_kernel[lambda meta: (triton.cdiv(M, meta["BLOCK_M"]),)](
+            x,
+            weight,
+            out,
+            M,
+            triton.next_power_of_2(M),
+            N,
+            K,
+            r,
+            x.stride(0),
+            x.stride(1),
+            weight.stride(0),
+            weight.stride(1),
+            out.stride(0),
+            out.stride(1),
+            BLOCK_N=max(16, triton.next_power_of_2(N)),
+            DOT_PRECISION=_dot_precision(x.dtype),
+        )
+        ctx.save_for_backward(x, weight, out)
+        ctx.r = r
+        return out
+
+    @staticmethod
+    @torch.amp.custom_bwd(device_type="cuda")
+    def backward(ctx, grad_out):
+        x, weight, out = ctx.saved_tensors
+        r = ctx.r
+        # softmax backward on the router columns only: p * (g - sum(g * p))
+        router_weight = out[:, r:].float()
+        grad_router = grad_out[:, r:].float()
+        grad_router = router_weight * (grad_router - (grad_router * router_weight).sum(dim=-1, keepdim=True))
+        grad_logits = torch.cat([grad_out[:, :r], grad_router.to(grad_out.dtype)], dim=-1)
+
+        grad_x = grad_weight = None
+        # `x` and `weight` are saved after the autocast cast, the gradients go back to the dtypes of the inputs
+        if ctx.needs_input_grad[0]:
+            grad_x = (grad_logits @ weight.to(grad_logits.dtype)).to(ctx.x_dtype)
+        if ctx.needs_input_grad[1]:
+            grad_weight = (grad_logits.t() @ x.to(grad_logits.dtype)).to(ctx.weight_dtype)
+        return grad_x, grad_weight, None
+
+
+def router_gemm_softmax(x, weight, r):
+    """
+    Computes `x @ weight^T` for the fused `lora_AR` projection and applies the softmax of the router columns in the
+    GEMM epilogue, so the router logits are never written out before being normalized.
+
+    Supports autograd, the backward pass is computed with PyTorch ops.
+
+    Args:
+        x (`torch.Tensor`): Input of shape `(..., in_features // lora_head)`.
+        weight (`torch.Tensor`):
+            The `lora_AR` weight of shape `(r + r_router, in_features // lora_head)`, at most
+            `ROUTER_GEMM_SOFTMAX_MAX_N` rows.
+        r (`int`): The number of leading `lora_A` rows that are left unnormalized.
+    """
+    leading_shape = x.shape[:-1]
+    out = _RouterGemmSoftmax.apply(x.reshape(-1, x.shape[-1]), weight, r)
+    return out.view(*leading_shape, weight.shape[0])
+
+
+if is_numba_available():
+    from numba import njit, prange
+
+    # rows x features tiles that fit in L1 next to the rank-sized accumulators
+    _CPU_BLOCK_M = 32
+    _CPU_BLOCK_K = 64
+
+    # `cache=True` keeps the compiled kernel on disk, so only the first process pays for the JIT compilation
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _lora_cpu_kernel(x, lora_A, lora_R, lora_B, scaling, lora_head, router_mode, router_activation, out):
+        M = x.shape[0]
+        r, k_head = lora_A.shape
+        n_router = lora_R.shape[0]
+        n_head = lora_B.shape[0]
+        n_blocks = (M + _CPU_BLOCK_M - 1) // _CPU_BLOCK_M
+        # one task per (row tile, head), every task writes its own slice of `out`
+        for task in prange(n_blocks * lora_head):
+            m_start = (task // lora_head) * _CPU_BLOCK_M
+            head = task % lora_head
+            rows = min(_CPU_BLOCK_M, M - m_start)
+            left = np.zeros((_CPU_BLOCK_M, r), dtype=np.float32)
+            logits = np.zeros((_CPU_BLOCK_M, n_router), dtype=np.float32)
+            for k_start in range(0, k_head, _CPU_BLOCK_K):
+                k_end = min(k_start + _CPU_BLOCK_K, k_head)
+                for i in range(rows):
+                    offset = head * k_head
+                    for j in range(r):
+                        acc = np.float32(0.0)
+                        for k in range(k_start, k_end):
+                            acc += x[m_start + i, offset + k] * lora_A[j, k]
+                        left[i, j] += acc
+                    for j in range(n_router):
+                        acc = np.float32(0.0)
+                        for k in range(k_start, k_end):
+                            acc += x[m_start + i, offset + k] * lora_R[j, k]
+                        logits[i, j] += acc
+
+            moe = np.empty(r, dtype=np.float32)
+            for i in range(rows):
+                if router_activation == 0 and router_mode != 0:
+                    # softmax
+                    max_logit = logits[i].max()
+                    total = np.float32(0.0)
+                    for j in range(n_router):
+                        logits[i, j] = np.exp(logits[i, j] - max_logit)
+                        total += logits[i, j]
+                    for j in range(n_router):
+                        logits[i, j] /= total
+                elif router_activation == 1 and router_mode != 0:
+                    # sigmoid
+                    for j in range(n_router):
+                        logits[i, j] = 1.0 / (1.0 + np.exp(-logits[i, j]))
+
+                if router_mode == 0:
+                    for j in range(r):
+                        moe[j] = left[i, j]
+                elif router_mode == 1:
+                    for j in range(r):
+                        moe[j] = left[i, j] * logits[i, j]
+                else:
+                    for k in range(r):
+                        acc = np.float32(0.0)
+                        for j in range(r):
+                            acc += left[i, j] * logits[i, j * r + k]
+                        moe[k] = acc
+
+                for n in range(n_head):
+                    acc = np.float32(0.0)
+                    for j in range(r):
+                        acc += lora_B[n, j] * moe[j]
+                    out[m_start + i, head * n_head + n] = scaling * acc
+
+
+_CPU_ROUTER_ACTIVATIONS = {"softmax": 0, "sigmoid": 1, "identity": 2}
+
+
+def lora_cpu_forward(x, lora_A, lora_B, lora_R, scaling, lora_head, router_mixer=False, router_activation="softmax"):
+    """
+    Computes the routed LoRA branch of [`~peft.tuners.lora.Linear`] on the CPU with a single Numba kernel.
+
+    Every (row tile, head) pair is handled by one parallel task that keeps the rank-sized intermediates in its own
+    buffers. This avoids the dispatch overhead of the small rank-`r` products for a few tokens, but BLAS is faster for
+    long sequences and the mixer, which is why [`~peft.tuners.lora.Linear`] only dispatches here with
+    `lora_cpu_kernel=True`. Computation is done in float32 and no autograd graph is recorded, so this is only meant for
+    inference.
+
+    Args:
+        x (`torch.Tensor`): Input of shape `(..., in_features)`.
+        lora_A (`torch.Tensor`): Weight of shape `(r, in_features // lora_head)`.
+        lora_B (`torch.Tensor`): Weight of shape `(out_features // lora_head, r)`.
+        lora_R (`torch.Tensor`, *optional*): Router weight, see [`fused_lora_forward`]. `None` disables routing.
+        scaling (`float`): Scaling applied to the LoRA branch.
+        lora_head (`int`): The number of heads the features are split into.
+        router_mixer (`bool`): Whether `lora_R` produces a full `r x r` mixer instead of a diagonal.
+        router_activation (`str`): The normalization of the router logits, 'softmax', 'sigmoid' or 'identity'.
+    """
+    leading_shape = x.shape[:-1]
+    x = np.ascontiguousarray(x.reshape(-1, x.shape[-1]).float().numpy())
+    lora_A = np.ascontiguousarray(lora_A.float().numpy())
+    lora_B = np.ascontiguousarray(lora_B.float().numpy())
+    if lora_R is None:
+        router_mode = 0
+        lora_R = np.zeros((0, lora_A.shape[1]), dtype=np.float32)
+    else:
+        router_mode = 2 if router_mixer else 1
+        lora_R = np.ascontiguousarray(lora_R.float().numpy())
+
+    out = np.empty((x.shape[0], lora_B.shape[0] * lora_head), dtype=np.float32)
+    _lora_cpu_kernel(
+        x,
+        lora_A,
+        lora_R,
+        lora_B,
+        np.float32(scaling),
+        lora_head,
+        router_mode,
+        _CPU_ROUTER_ACTIVATIONS[router_activation],
+        out,
+    )
+    return torch.from_numpy(out).view(*leading_shape, -1)
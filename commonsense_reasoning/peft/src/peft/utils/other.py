@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+
 import torch
 
 
@@ -157,3 +159,22 @@ def fsdp_auto_wrap_policy(model):
 
 def transpose(weight, fan_in_fan_out):
     return weight.T if fan_in_fan_out else weight
+
+
+def get_target_module_matcher(target_modules):
+    """
+    Returns a callable telling whether a module key is targeted, so the check is set up once instead of per key.
+
+    Args:
+        target_modules (`Union[List[str], str]`):
+            A regex that has to match the full key, or a list of suffixes of which at least one has to end the key.
+    """
+    if isinstance(target_modules, str):
+        return re.compile(target_modules).fullmatch
+    # `str.endswith` checks all the suffixes of a tuple in one call
+    target_suffixes = tuple(target_modules)
+
+    def target_module_matcher(key):
+        return key.endswith(target_suffixes)
+
+    return target_module_matcher
@@ -94,3 +94,24 @@ class PeftConfigTester(unittest.TestCase, PeftConfigTestMixin):
 
                 config_from_pretrained = config_class.from_pretrained(tmp_dirname)
                 self.assertEqual(config.to_dict(), config_from_pretrained.to_dict())
+
+    def test_lora_config_dict_cache(self):
+        # the cached dict used by `LoraModel.get_peft_config_as_dict` has to follow later updates of the config
+        config = LoraConfig(r=4)
+        self.assertEqual(config._as_dict()["r"], 4)
+        self.assertEqual(config._as_dict()["peft_type"], "LORA")
+
+        config.r = 16
+        self.assertEqual(config._as_dict()["r"], 16)
+        self.assertNotIn("_cached_dict", config.to_dict())
+
+    def test_lora_config_dict_cache_containers(self):
+        # lists are neither shared between the returned dicts nor stale after an in-place update of the config
+        config = LoraConfig(target_modules=["q", "v"])
+        config_dict = config._as_dict()
+        config_dict["target_modules"].append("k")
+        self.assertEqual(config.target_modules, ["q", "v"])
+        self.assertEqual(config._as_dict()["target_modules"], ["q", "v"])
+
+        config.target_modules.append("o")
+        self.assertEqual(config._as_dict()["target_modules"], ["q", "v", "o"])
@@ -0,0 +1,486 @@
+# coding=utf-8
+# Copyright 2023-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from unittest import mock
+
+import torch
+from parameterized import parameterized
+
+from peft import LoraConfig
+from peft.tuners.lora import ROUTER_ACTIVATIONS, Linear, LoraModel, is_bnb_available, mark_only_lora_as_trainable
+from peft.tuners.lora_kernels import (
+    fused_lora_forward,
+    fused_lora_supported,
+    is_numba_available,
+    router_gemm_softmax,
+)
+
+from .testing_utils import require_bitsandbytes, require_torch_gpu
+
+
+if is_bnb_available():
+    import bitsandbytes as bnb
+
+
+# This has to be in the order: lora_router, lora_router_mixer
+LORA_ROUTER_SETTINGS = [
+    (False, False),
+    (True, False),
+    (True, True),
+]
+
+# This has to be in the order: lora_router, lora_router_mixer, router_activation. The activation has no effect
+# without a router, so that setting is only listed once.
+LORA_ROUTER_ACTIVATION_SETTINGS = [(False, False, "softmax")] + [
+    (True, lora_router_mixer, router_activation)
+    for lora_router_mixer in (False, True)
+    for router_activation in ROUTER_ACTIVATIONS
+]
+
+
+class LoraLinearTester(unittest.TestCase):
+    r"""
+    Test the MoSLoRA `Linear` layer directly, without going through a pretrained model.
+    """
+
+    def _make_linear(self, lora_router, lora_router_mixer, merge_weights=False, r=8, **kwargs):
+        torch.manual_seed(0)
+        linear = Linear(
+            64,
+            32,
+            r=r,
+            lora_alpha=16,
+            lora_dropout=0.0,
+            merge_weights=merge_weights,
+            lora_router=lora_router,
+            lora_router_mixer=lora_router_mixer,
+            **kwargs,
+        )
+        # B is initialized to zero, which would hide any difference in the LoRA branch
+        torch.nn.init.normal_(linear.lora_B.weight)
+        return linear
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_load_unfused_state_dict(self, lora_router, lora_router_mixer):
+        linear = self._make_linear(lora_router, lora_router_mixer)
+        state_dict = linear.state_dict()
+        lora_A, lora_R = state_dict.pop("lora_AR.weight").split([linear.r, linear.r_router])
+        state_dict["lora_A.weight"] = lora_A
+        state_dict["lora_R.weight"] = lora_R
+
+        loaded = self._make_linear(lora_router, lora_router_mixer)
+        torch.nn.init.zeros_(loaded.lora_AR.weight)
+        loaded.load_state_dict(state_dict)
+
+        self.assertTrue(torch.equal(loaded.lora_AR.weight, linear.lora_AR.weight))
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_eval_folds_scaling(self, lora_router, lora_router_mixer):
+        linear = self._make_linear(lora_router, lora_router_mixer, merge_weights=True)
+        lora_B = linear.lora_B.weight.detach().clone()
+        x = torch.randn(2, 3, 64)
+        with torch.no_grad():
+            train_output = linear(x)
+            linear.eval()
+            eval_output = linear(x)
+
+        self.assertTrue(torch.allclose(train_output, eval_output, atol=1e-5))
+        self.assertTrue(torch.allclose(linear.state_dict()["lora_B.weight"], lora_B))
+
+        linear.train()
+        self.assertTrue(torch.allclose(linear.lora_B.weight, lora_B))
+
+    def test_eval_merges_weights_without_router(self):
+        linear = self._make_linear(False, False, merge_weights=True)
+        weight = linear.weight.detach().clone()
+        x = torch.randn(2, 3, 64)
+        with torch.no_grad():
+            train_output = linear(x)
+            linear.eval()
+            eval_output = linear(x)
+
+        self.assertTrue(linear.merged)
+        self.assertTrue(torch.allclose(train_output, eval_output, atol=1e-5))
+
+        linear.train()
+        self.assertFalse(linear.merged)
+        self.assertTrue(torch.allclose(linear.weight, weight, atol=1e-6))
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_disable_adapters(self, lora_router, lora_router_mixer):
+        linear = self._make_linear(lora_router, lora_router_mixer, merge_weights=True)
+        x = torch.randn(2, 3, 64)
+        base_output = torch.nn.functional.linear(x, linear.weight, linear.bias)
+        linear.eval()
+        linear.disable_adapters = True
+        with torch.no_grad():
+            output = linear(x)
+
+        self.assertTrue(torch.allclose(output, base_output, atol=1e-5))
+
+    @parameterized.expand(LORA_ROUTER_ACTIVATION_SETTINGS)
+    def test_router_activation(self, lora_router, lora_router_mixer, router_activation):
+        linear = self._make_linear(lora_router, lora_router_mixer, router_activation=router_activation)
+        x = torch.randn(2, 5, 64, requires_grad=True)
+        output = linear._lora_forward(x)
+
+        # per-head reference, written without the fused lora_AR projection
+        heads = x.view(2, 5, linear.lora_head, linear.in_per_head)
+        lora_A, lora_R = linear.lora_AR.weight.split([linear.r, linear.r_router])
+        left = heads @ lora_A.T
+        if lora_router:
+            activation = {"softmax": lambda t: t.softmax(-1), "sigmoid": torch.sigmoid, "identity": lambda t: t}
+            router_weight = activation[router_activation](heads @ lora_R.T)
+            if lora_router_mixer:
+                mixer = router_weight.view(2, 5, linear.lora_head, linear.r, linear.r)
+                left = (left.unsqueeze(-2) @ mixer).squeeze(-2)
+            else:
+                left = left * router_weight
+        expected = (left @ linear.lora_B.weight.T * linear.scaling).reshape(2, 5, 32)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+        # the in-place sigmoid must not be taken while autograd records the router
+        grad = torch.autograd.grad(output.sum(), linear.lora_AR.weight)[0]
+        expected_grad = torch.autograd.grad(expected.sum(), linear.lora_AR.weight)[0]
+        self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-4))
+
+    def test_sigmoid_router_in_place(self):
+        router_weight = torch.randn(4, 8)
+        expected = torch.sigmoid(router_weight)
+        # without autograd the input is reused
+        output = ROUTER_ACTIVATIONS["sigmoid"](router_weight)
+        self.assertEqual(output.data_ptr(), router_weight.data_ptr())
+        self.assertTrue(torch.allclose(output, expected))
+
+        router_weight = torch.randn(4, 8, requires_grad=True)
+        original = router_weight.detach().clone()
+        output = ROUTER_ACTIVATIONS["sigmoid"](router_weight)
+        self.assertTrue(torch.equal(router_weight.detach(), original))
+        self.assertTrue(torch.allclose(output, torch.sigmoid(original)))
+
+    def test_unknown_router_activation(self):
+        with self.assertRaises(ValueError):
+            self._make_linear(True, False, router_activation="relu")
+
+    @parameterized.expand(LORA_ROUTER_ACTIVATION_SETTINGS)
+    @unittest.skipIf(not is_numba_available(), "test requires numba")
+    def test_cpu_kernel_matches_eager(self, lora_router, lora_router_mixer, router_activation):
+        # the kernel is opt-in
+        default_linear = self._make_linear(lora_router, lora_router_mixer, router_activation=router_activation)
+        default_linear.eval()
+        with torch.no_grad():
+            self.assertFalse(default_linear._use_cpu_kernel(torch.randn(2, 64)))
+
+        linear = self._make_linear(
+            lora_router, lora_router_mixer, router_activation=router_activation, lora_cpu_kernel=True
+        )
+        linear.eval()
+        x = torch.randn(2, 37, 64)
+        with torch.no_grad():
+            self.assertTrue(linear._use_cpu_kernel(x))
+            output = linear(x)
+            expected = linear._lora_forward(x) + torch.nn.functional.linear(x, linear.weight, linear.bias)
+
+        self.assertEqual(output.shape, expected.shape)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-4))
+
+    @parameterized.expand(LORA_ROUTER_ACTIVATION_SETTINGS)
+    def test_scratch_buffers_match_eager(self, lora_router, lora_router_mixer, router_activation):
+        linear = self._make_linear(lora_router, lora_router_mixer, router_activation=router_activation)
+        linear.eval()
+        x = torch.randn(2, 37, 64)
+        with torch.no_grad():
+            expected = linear._lora_forward(x) + torch.nn.functional.linear(x, linear.weight, linear.bias)
+            output = linear._add_lora_inplace(x, torch.nn.functional.linear(x, linear.weight, linear.bias))
+            # the second call reuses the buffers and must not touch the first result
+            first_output = output.clone()
+            linear._add_lora_inplace(x, torch.nn.functional.linear(x, linear.weight, linear.bias))
+
+        self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+        self.assertTrue(torch.equal(output, first_output))
+
+        linear.train()
+        self.assertIsNone(linear._scratch)
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_lora_dtype_with_full_precision_base(self, lora_router, lora_router_mixer):
+        linear = self._make_linear(lora_router, lora_router_mixer, lora_dtype="bfloat16")
+        self.assertEqual(linear.weight.dtype, torch.float32)
+        self.assertEqual(linear.lora_AR.weight.dtype, torch.bfloat16)
+        self.assertEqual(linear.lora_B.weight.dtype, torch.bfloat16)
+
+        x = torch.randn(2, 5, 64)
+        base_output = torch.nn.functional.linear(x, linear.weight, linear.bias)
+        lora_result = linear._lora_forward(x)
+        self.assertEqual(lora_result.dtype, torch.bfloat16)
+
+        output = linear(x)
+        self.assertEqual(output.dtype, torch.float32)
+        self.assertTrue(torch.allclose(output, base_output + lora_result.float(), atol=1e-5))
+        output.sum().backward()
+        self.assertEqual(linear.lora_B.weight.grad.dtype, torch.bfloat16)
+
+        # the bf16 update cannot be accumulated into the fp32 result with addmm_, so the scratch path adds it instead
+        linear.eval()
+        with torch.no_grad():
+            output = linear(x)
+            expected = base_output + linear._lora_forward(x).float()
+        self.assertIsNotNone(linear._scratch)
+        self.assertEqual(output.dtype, torch.float32)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-2, rtol=1e-2))
+
+    @unittest.skipIf(not hasattr(torch, "compiler"), "test requires torch.compiler")
+    def test_compiled_branch_across_sequence_lengths(self):
+        from torch._dynamo.utils import counters
+
+        torch._dynamo.reset()
+        counters.clear()
+        model = torch.nn.Sequential(
+            self._make_linear(True, False, lora_compile=True),
+            Linear(32, 64, r=8, lora_alpha=16, lora_router=True, merge_weights=False, lora_compile=True),
+        )
+        for seq_len in range(3, 11):
+            x = torch.randn(2, seq_len, 64)
+            output = model(x)
+            output.sum().backward()
+
+            expected = x
+            for linear in model:
+                lora_result = linear._lora_forward(expected)
+                expected = lora_result + torch.nn.functional.linear(expected, linear.weight, linear.bias)
+            self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+        # the number of tokens becomes dynamic instead of compiling one graph per sequence length
+        self.assertLessEqual(counters["stats"]["unique_graphs"], 4)
+        torch._dynamo.reset()
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    @unittest.skipIf(not hasattr(torch, "compiler"), "test requires torch.compiler")
+    def test_scratch_buffers_skipped_when_compiled(self, lora_router, lora_router_mixer):
+        # a compiled model must not trace the scratch buffer cache, which would break the graph in every layer
+        model = torch.nn.Sequential(
+            self._make_linear(lora_router, lora_router_mixer),
+            Linear(32, 64, r=8, lora_alpha=16, lora_router=lora_router, lora_router_mixer=lora_router_mixer),
+        )
+        model.eval()
+        x = torch.randn(2, 5, 64)
+        with torch.no_grad():
+            explanation = torch._dynamo.explain(model)(x)
+        torch._dynamo.reset()
+        self.assertEqual(explanation.graph_break_count, 0)
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_scratch_buffers_across_grad_modes(self, lora_router, lora_router_mixer):
+        linear = self._make_linear(lora_router, lora_router_mixer)
+        linear.eval()
+        x = torch.randn(2, 37, 64)
+        with torch.no_grad():
+            expected = linear._lora_forward(x) + torch.nn.functional.linear(x, linear.weight, linear.bias)
+
+        # buffers created under inference mode must not be reused outside of it, and the other way around
+        for grad_mode in (torch.inference_mode, torch.no_grad, torch.inference_mode):
+            with grad_mode():
+                self.assertTrue(linear._use_scratch(x))
+                output = linear._add_lora_inplace(x, torch.nn.functional.linear(x, linear.weight, linear.bias))
+            self.assertTrue(torch.allclose(output, expected, atol=1e-5))
+
+    @parameterized.expand(LORA_ROUTER_ACTIVATION_SETTINGS)
+    @require_torch_gpu
+    def test_fused_kernel_matches_eager(self, lora_router, lora_router_mixer, router_activation):
+        # the kernel is opt-in
+        default_linear = self._make_linear(lora_router, lora_router_mixer, router_activation=router_activation)
+        default_linear.cuda().eval()
+        with torch.no_grad():
+            self.assertFalse(default_linear._use_fused_kernel(torch.randn(2, 64, device="cuda")))
+
+        linear = self._make_linear(
+            lora_router, lora_router_mixer, router_activation=router_activation, lora_fused_kernel=True
+        ).cuda()
+        linear.eval()
+        # odd number of tokens, so the row tiles are partially masked
+        x = torch.randn(3, 37, 64, device="cuda")
+        with torch.no_grad():
+            self.assertTrue(linear._use_fused_kernel(x))
+            output = linear(x)
+            expected = linear._lora_forward(x) + torch.nn.functional.linear(x, linear.weight, linear.bias)
+
+        self.assertEqual(output.shape, expected.shape)
+        # float32 inputs follow `allow_tf32`, which is off by default, so there is no TF32 rounding
+        self.assertTrue(torch.allclose(output, expected, atol=1e-4, rtol=1e-4))
+
+    @parameterized.expand([(8,), (64,)])
+    @require_torch_gpu
+    def test_router_gemm_softmax(self, r_router):
+        torch.manual_seed(0)
+        # 37 x 3 rows, so the last row tile is partially masked
+        x = torch.randn(3, 37, 24, device="cuda", requires_grad=True)
+        weight = torch.randn(8 + r_router, 24, device="cuda", requires_grad=True)
+        output = router_gemm_softmax(x, weight, 8)
+
+        logits = x @ weight.T
+        expected = torch.cat([logits[..., :8], logits[..., 8:].softmax(-1)], dim=-1)
+        self.assertTrue(torch.allclose(output, expected, atol=1e-2, rtol=1e-2))
+
+        grad_output = torch.randn_like(expected)
+        grad_x, grad_weight = torch.autograd.grad(output, (x, weight), grad_output)
+        expected_grad_x, expected_grad_weight = torch.autograd.grad(expected, (x, weight), grad_output)
+        self.assertTrue(torch.allclose(grad_x, expected_grad_x, atol=1e-2, rtol=1e-2))
+        self.assertTrue(torch.allclose(grad_weight, expected_grad_weight, atol=1e-2, rtol=1e-2))
+
+    @require_torch_gpu
+    def test_router_gemm_softmax_autocast(self):
+        torch.manual_seed(0)
+        x = torch.randn(3, 37, 24, device="cuda", requires_grad=True)
+        weight = torch.randn(16, 24, device="cuda", requires_grad=True)
+        with torch.autocast("cuda", dtype=torch.float16):
+            # like the eager lora_AR GEMM, the kernel runs in the autocast dtype
+            output = router_gemm_softmax(x, weight, 8)
+            logits = x @ weight.T
+            expected = torch.cat([logits[..., :8], logits[..., 8:].softmax(-1)], dim=-1)
+        self.assertEqual(output.dtype, torch.float16)
+        self.assertTrue(torch.allclose(output.float(), expected.float(), atol=1e-2, rtol=1e-2))
+
+        grad_x, grad_weight = torch.autograd.grad(output.float().sum(), (x, weight))
+        self.assertEqual(grad_x.dtype, torch.float32)
+        self.assertEqual(grad_weight.dtype, torch.float32)
+
+    @parameterized.expand([(False,), (True,)])
+    @require_torch_gpu
+    def test_router_kernel_is_opt_in(self, lora_router_mixer):
+        x = torch.randn(2, 64, device="cuda")
+        self.assertFalse(self._make_linear(True, lora_router_mixer).cuda()._use_router_kernel(x))
+        linear = self._make_linear(True, lora_router_mixer, lora_router_kernel=True).cuda()
+        self.assertTrue(linear._use_router_kernel(x))
+        output = linear._lora_forward(x)
+        linear.lora_router_kernel = False
+        self.assertTrue(torch.allclose(output, linear._lora_forward(x), atol=1e-4, rtol=1e-4))
+
+    def test_fused_kernel_rejects_large_mixer(self):
+        self.assertTrue(fused_lora_supported(16, 4, router_mixer=True))
+        self.assertFalse(fused_lora_supported(32, 4, router_mixer=True))
+        self.assertTrue(fused_lora_supported(32, 4, router_mixer=False))
+
+        linear = self._make_linear(True, True, r=32)
+        self.assertFalse(linear._fused_kernel_supported)
+        with self.assertRaises(ValueError):
+            fused_lora_forward(
+                torch.randn(2, 64),
+                linear.weight,
+                linear.lora_AR.weight[: linear.r],
+                linear.lora_B.weight,
+                linear.lora_AR.weight[linear.r :],
+                linear.scaling,
+                linear.lora_head,
+                router_mixer=True,
+            )
+
+    @parameterized.expand([("none",), ("all",), ("lora_only",)])
+    def test_mark_only_lora_as_trainable(self, bias):
+        model = torch.nn.Sequential(torch.nn.Linear(64, 64), self._make_linear(True, False))
+        mark_only_lora_as_trainable(model, bias)
+        trainable = {n for n, p in model.named_parameters() if p.requires_grad}
+        expected = {"1.lora_AR.weight", "1.lora_B.weight"}
+        expected |= {"0.bias", "1.bias"} if bias == "all" else {"1.bias"} if bias == "lora_only" else set()
+        self.assertEqual(trainable, expected)
+
+        # an unchanged model needs no write at all
+        with mock.patch.object(
+            torch.nn.Parameter, "requires_grad_", autospec=True, side_effect=torch.Tensor.requires_grad_
+        ) as requires_grad_:
+            mark_only_lora_as_trainable(model, bias)
+        requires_grad_.assert_not_called()
+
+    @parameterized.expand(LORA_ROUTER_SETTINGS)
+    def test_fan_in_fan_out_matches_base_layer(self, lora_router, lora_router_mixer):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential()
+        model.add_module("q_proj", torch.nn.Linear(64, 64))
+        # the base layer stores its weight like a Conv1D, as (fan_in, fan_out)
+        weight = model.q_proj.weight.detach().clone()
+        bias = model.q_proj.bias.detach().clone()
+        config = LoraConfig(
+            r=8,
+            lora_alpha=16,
+            lora_dropout=0.0,
+            target_modules=["q_proj"],
+            fan_in_fan_out=True,
+            lora_router=lora_router,
+            lora_router_mixer=lora_router_mixer,
+        )
+        linear = LoraModel(config, model).model.q_proj
+        self.assertIsInstance(linear, Linear)
+
+        x = torch.randn(2, 5, 64)
+        base_output = torch.nn.functional.linear(x, weight.T, bias)
+        with torch.no_grad():
+            # lora_B starts at zero, so the layer has to reproduce the base layer exactly
+            self.assertTrue(torch.allclose(linear(x), base_output, atol=1e-5))
+
+            torch.nn.init.normal_(linear.lora_B.weight)
+            expected = base_output + linear._lora_forward(x)
+            self.assertTrue(torch.allclose(linear(x), expected, atol=1e-5))
+
+
+class LoraLinear4bitTester(unittest.TestCase):
+    r"""
+    Test the `Linear4bit` layers inserted with `quantize_base`.
+    """
+
+    def _make_model(self, fan_in_fan_out=False):
+        torch.manual_seed(0)
+        model = torch.nn.Sequential()
+        model.add_module("q_proj", torch.nn.Linear(64, 64))
+        weight = model.q_proj.weight.detach().clone()
+        config = LoraConfig(
+            r=8,
+            lora_alpha=16,
+            lora_dropout=0.0,
+            target_modules=["q_proj"],
+            lora_router=True,
+            quantize_base=True,
+            fan_in_fan_out=fan_in_fan_out,
+        )
+        lora_model = LoraModel(config, model.cuda())
+        linear = lora_model.model.q_proj
+        torch.nn.init.normal_(linear.lora_B.weight)
+        return lora_model, linear, weight
+
+    def _dequantize(self, linear):
+        return bnb.functional.dequantize_4bit(linear.weight.data, linear.weight.quant_state)
+
+    @require_bitsandbytes
+    @require_torch_gpu
+    def test_forward_matches_dequantized_weight(self):
+        _, linear, weight = self._make_model()
+        self.assertIsInstance(linear, bnb.nn.Linear4bit)
+        dequantized = self._dequantize(linear)
+        # nf4 keeps the weight within its quantization error
+        self.assertTrue(torch.allclose(dequantized.float().cpu(), weight, atol=0.05))
+
+        x = torch.randn(2, 5, 64, device="cuda", dtype=torch.bfloat16)
+        with torch.no_grad():
+            output = linear(x)
+            base_output = torch.nn.functional.linear(x, dequantized.to(x.dtype), linear.bias.to(x.dtype))
+            expected = base_output + linear._lora_forward(x).to(x.dtype)
+            self.assertTrue(torch.allclose(output, expected, atol=5e-2, rtol=5e-2))
+
+            linear.disable_adapters = True
+            self.assertTrue(torch.allclose(linear(x), base_output, atol=5e-2, rtol=5e-2))
+
+    @require_bitsandbytes
+    @require_torch_gpu
+    def test_fan_in_fan_out_is_transposed_before_quantization(self):
+        _, linear, weight = self._make_model(fan_in_fan_out=True)
+        self.assertTrue(torch.allclose(self._dequantize(linear).float().cpu(), weight.T, atol=0.05))